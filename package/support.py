@@ -1,13 +1,53 @@
-from azure.storage.blob import BlobServiceClient
+from azure.storage.blob.aio import BlobServiceClient
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import json
+import os
 import geopandas as gpd
+import numpy as np
+import shapely
 import plotly.graph_objects as go
 import plotly.io as pio
 
+# Figure geojson cache, keyed by geographic boundary
+_GEOJSON_CACHE = OrderedDict()
+_GEOJSON_CACHE_SIZE = 2
+
+# Figure map layout
+_AUST_LAYOUT = go.Layout(
+    mapbox=dict(
+        style="carto-positron",
+        center=dict(
+            lat=-25,
+            lon=130
+        ),
+        zoom=2,
+        bounds=dict(
+            west=85,
+            east=185,
+            north=0,
+            south=-50
+        )
+    ),
+    autosize=True,
+    margin=dict(
+        l=0,
+        r=0,
+        t=0,
+        b=0
+    ),
+    height=650,
+    width=1300
+)
+
 def load_raw(
         work_dir: str,
         data_config: dict,
         cloud: bool = False,
-        overwrite: bool = False
+        overwrite: bool = False,
+        gdf_column: dict = None
     ) -> gpd.GeoDataFrame:
     """
     Description
@@ -21,9 +61,12 @@ def load_raw(
     - data_config : dict
         Dictionary with data configuration.
     - cloud : bool = False
-        Use cloud data.
+        Download data from cloud storage first.
     - overwrite : bool = False
         Overwrite data if it exists.
+    - gdf_column : dict = None
+        Dictionary with column info, only the location name and this
+        column are read when set.
 
     Returns
     -------
@@ -31,31 +74,47 @@ def load_raw(
         Geopandas dataframe.
     """
 
+    # Set columns to read
+    columns = None
+    if gdf_column is not None:
+        columns = [
+            f"{data_config['gda_type']}_NAME_{data_config['data_year']}",
+            gdf_column['name']
+        ]
+
     if cloud:
-        conn_str = data_config['conn_str']
-        gdf = load_cloud_data(conn_str)
-    else:
-        gdf = load_local_data(
+        folder = \
+            f"Geopackage_{data_config['data_year']}_" \
+            f"{data_config['data_topic']}_{data_config['geo_area']}_" \
+            f"{data_config['gda_spec']}"
+        load_cloud_data(
+            data_config['conn_str'],
             work_dir,
-            data_config['data_year'],
-            data_config['data_topic'],
-            data_config['geo_area'],
-            data_config['gda_spec'],
-            data_config['gda_type']
+            f'raw/{folder}/',
+            overwrite
         )
 
+    gdf = load_local_data(
+        work_dir,
+        data_config['data_year'],
+        data_config['data_topic'],
+        data_config['geo_area'],
+        data_config['gda_spec'],
+        data_config['gda_type'],
+        columns,
+        overwrite=overwrite
+    )
+
     return gdf
 
 def load_pro(
         work_dir: str,
-        data_config: dict,
-        cloud: bool = False,
-        overwrite: bool = False
+        data_config: dict
     ) -> gpd.GeoDataFrame:
     """
     Description
     -----------
-    Load geographic census data from a local file.
+    Load processed geographic census data from a parquet file.
 
     Parameters
     ----------
@@ -63,10 +122,6 @@ def load_pro(
         Working directory.
     - data_config : dict
         Dictionary with data configuration.
-    - cloud : bool = False
-        Use cloud data.
-    - overwrite : bool = False
-        Overwrite data if it exists.
 
     Returns
     -------
@@ -74,18 +129,16 @@ def load_pro(
         Geopandas dataframe.
     """
 
-    if cloud:
-        conn_str = data_config['conn_str']
-        gdf = load_cloud_data(conn_str)
-    else:
-        gdf = load_local_data(
-            work_dir,
-            data_config['data_year'],
-            data_config['data_topic'],
-            data_config['geo_area'],
-            data_config['gda_spec'],
-            data_config['gda_type']
-        )
+    # Set file name
+    filename = \
+        f"{data_config['data_topic']}_{data_config['gda_type']}_" \
+        f"{data_config['data_year']}_{data_config['geo_area']}_" \
+        f"{data_config['gda_spec']}"
+
+    # Load data
+    gdf = gpd.read_parquet(
+        f"{work_dir}/pro/{filename}.parquet"
+    )
 
     return gdf
 
@@ -117,42 +170,189 @@ def process_data(
         Geopandas dataframe.
     """
 
-    # Create columns
-    gdf_columns = [
+    # Set location column name
+    name_column = f'{gda_type}_NAME_{data_year}'
+
+    # Filter data
+    mask = gdf.geometry.notna().to_numpy()
+
+    locations = gdf[name_column].to_numpy()[mask]
+    if locations.dtype != object:
+        locations = locations.astype(str)
+
+    values = gdf[gdf_column['name']][mask].reset_index(drop=True)
+    values = values.astype(gdf_column['type'], copy=False)
+
+    # Create dataframe with updated names and types
+    attrs = gdf.attrs
+    gdf = gpd.GeoDataFrame(
         {
-            'name': f'{gda_type}_NAME_{data_year}',
-            'rename': 'Location',
-            'type': 'str'
+            'Location': locations,
+            gdf_column['rename']: values
         },
-        gdf_column,
-        {
-            'name': 'geometry',
-            'rename': 'geometry',
-            'type': 'geometry'
-        }
-    ]
+        geometry=gdf.geometry.values[mask],
+        crs=gdf.crs
+    )
+    gdf.attrs.update(attrs)
 
-    # Filter data and columns
-    gdf = gdf[
-        gdf['geometry'] != None
-    ]
-    gdf = gdf.reset_index(drop=True)
+    return gdf
 
-    columns = [x['name'] for x in gdf_columns]
-    gdf = gdf[columns]
+def _cull_viewport(
+        figure_df: gpd.GeoDataFrame,
+        viewport: dict
+    ) -> gpd.GeoDataFrame:
+    """
+    Description
+    -----------
+    Clip geometries to a viewport and drop locations outside it.
 
-    # Update names and types
-    column_names = {x['name']: x['rename'] for x in gdf_columns}
-    gdf = gdf.rename(columns=column_names)
+    Parameters
+    ----------
+    - figure_df : geopandas.GeoDataFrame
+        Geopandas dataframe indexed by location.
+    - viewport : dict
+        Viewport bounds (west, east, south, north).
 
-    column_types = {x['rename']: x['type'] for x in gdf_columns}
-    gdf = gdf.astype(column_types)
+    Returns
+    -------
+    - figure_df : geopandas.GeoDataFrame
+        Geopandas dataframe within the viewport.
+    """
 
-    return gdf
+    # Clip geometries
+    geometries = shapely.clip_by_rect(
+        figure_df.geometry.to_numpy(),
+        viewport['west'],
+        viewport['south'],
+        viewport['east'],
+        viewport['north']
+    )
+
+    # Filter locations
+    mask = ~shapely.is_empty(geometries)
+    figure_df = figure_df.loc[mask].assign(geometry=geometries[mask])
+
+    return figure_df
+
+def _geojson_for(
+        figure_df: gpd.GeoDataFrame,
+        data_config: dict = None,
+        tolerance: float = None,
+        topology: bool = False
+    ) -> dict:
+    """
+    Description
+    -----------
+    Create figure geojson, reused for data loaded from the same
+    geographic boundary file (gda_type, data_year, geo_area, gda_spec
+    and file modified time) with the same crs and locations.
+
+    Parameters
+    ----------
+    - figure_df : geopandas.GeoDataFrame
+        Geopandas dataframe indexed by location.
+    - data_config : dict = None
+        Dictionary with data configuration (not cached if None, or if
+        the data was not loaded with load_local_data).
+    - tolerance : float = None
+        Geometry simplification tolerance in degrees, pick it to suit
+        the gda_type as each location is simplified separately (no
+        simplification if None).
+    - topology : bool = False
+        Simplify shared borders once as a topology so neighbouring
+        locations stay aligned, only used with a tolerance (the
+        geojson is no smaller than without it, requires topojson).
+
+    Returns
+    -------
+    - geojson : dict
+        Geojson feature collection.
+    """
+
+    # Check cache
+    key = None
+    source_mtime = figure_df.attrs.get('source_mtime')
+    if data_config is not None and source_mtime is not None:
+        key = (
+            data_config['gda_type'],
+            data_config['data_year'],
+            data_config['geo_area'],
+            data_config['gda_spec'],
+            source_mtime,
+            figure_df.crs,
+            tolerance,
+            topology
+        )
+        if key in _GEOJSON_CACHE:
+            index, geojson = _GEOJSON_CACHE[key]
+            if figure_df.index.equals(index):
+                _GEOJSON_CACHE.move_to_end(key)
+                return geojson
+
+    # Simplify geometries
+    geometries = figure_df.geometry.to_numpy()
+    if topology and tolerance is not None:
+        import topojson as tp
+
+        topo = tp.Topology(
+            figure_df.geometry.reset_index(drop=True),
+            prequantize=True,
+            toposimplify=tolerance
+        )
+        geometries = topo.to_gdf().geometry.to_numpy()
+        if len(geometries) != len(figure_df):
+            raise ValueError(
+                f"Topology returned {len(geometries)} geometries "
+                f"for {len(figure_df)} locations."
+            )
+    elif tolerance is not None:
+        geometries = shapely.simplify(
+            geometries,
+            tolerance,
+            preserve_topology=True
+        )
+
+    # Serialise geometries in bulk and parse once
+    geometries = shapely.to_geojson(geometries)
+    geometries = json.loads(
+        '[' + ','.join(
+            'null' if geometry is None else geometry
+            for geometry in geometries
+        ) + ']'
+    )
+
+    # Create feature collection
+    geojson = {
+        'type': 'FeatureCollection',
+        'features': [
+            {
+                'id': location,
+                'type': 'Feature',
+                'properties': {},
+                'geometry': geometry
+            }
+            for location, geometry in zip(
+                figure_df.index.to_numpy(),
+                geometries
+            )
+        ]
+    }
+
+    if key is not None:
+        _GEOJSON_CACHE[key] = (figure_df.index, geojson)
+        _GEOJSON_CACHE.move_to_end(key)
+        if len(_GEOJSON_CACHE) > _GEOJSON_CACHE_SIZE:
+            _GEOJSON_CACHE.popitem(last=False)
+
+    return geojson
 
 def create_figure(
         gdf: gpd.GeoDataFrame,
-        gdf_column: dict
+        gdf_column: dict,
+        data_config: dict = None,
+        tolerance: float = None,
+        topology: bool = False,
+        viewport: dict = None
     ) -> go.Figure:
     """
     Description
@@ -165,6 +365,20 @@ def create_figure(
         Geopandas dataframe.
     - gdf_column : dict
         Dictionary with column info.
+    - data_config : dict = None
+        Dictionary with data configuration, used to reuse the geojson
+        of the same geographic boundary across columns.
+    - tolerance : float = None
+        Geometry simplification tolerance in degrees, pick it to suit
+        the gda_type as each location is simplified separately (no
+        simplification if None).
+    - topology : bool = False
+        Simplify shared borders once as a topology so neighbouring
+        locations stay aligned, only used with a tolerance (the
+        geojson is no smaller than without it, requires topojson).
+    - viewport : dict = None
+        Viewport bounds (west, east, south, north) to clip geometries
+        to, the geojson is not cached when set.
 
     Returns
     -------
@@ -173,54 +387,40 @@ def create_figure(
     """
 
     # Create figure data
-    figure_df = gdf.copy()
-    figure_df = figure_df.set_index('Location')
-    figure_geojson = figure_df.__geo_interface__
-
-    # Create figure
-    figure = go.Figure()
+    figure_df = gdf.set_index('Location')
+    if viewport is not None:
+        figure_df = _cull_viewport(figure_df, viewport)
+        data_config = None
+
+    figure_geojson = _geojson_for(
+        figure_df,
+        data_config,
+        tolerance,
+        topology
+    )
+    figure_locations = figure_df.index.to_numpy()
+    figure_z = figure_df[gdf_column['rename']].to_numpy()
+    if figure_z.dtype == np.float64:
+        figure_z = figure_z.astype(np.float32)
 
-    # Create and add choroplethmap trace
+    # Create choroplethmap trace
     trace = go.Choroplethmapbox(
         name='Census Data',
         geojson=figure_geojson,
-        locations=figure_df.index,
-        z=figure_df[gdf_column['rename']],
+        locations=figure_locations,
+        z=figure_z,
         marker_opacity=0.5,
         hovertemplate= \
-            '<b>Location</b>: %{location}<br>'+\
-            '<b>'+gdf_column['rename']+'</b>: %{z:.2s}'+\
-            '<extra></extra>'
+            '<b>Location</b>: %{location}<br>' \
+            f'<b>{gdf_column["rename"]}</b>: ' \
+            '%{z:.2s}<extra></extra>'
     )
-    figure = figure.add_trace(trace)
-
-    # Create and add map layout
-    layout = go.Layout(
-        mapbox=dict(
-            style="carto-positron",
-            center=dict(
-                lat=-25,
-                lon=130
-            ),
-            zoom=2,
-            bounds=dict(
-                west=85,
-                east=185,
-                north=0,
-                south=-50
-            )
-        ),
-        autosize=True,
-        margin=dict(
-            l=0,
-            r=0,
-            t=0,
-            b=0
-        ),
-        height=650,
-        width=1300
+
+    # Create figure with map layout
+    figure = go.Figure(
+        data=[trace],
+        layout=_AUST_LAYOUT
     )
-    figure = figure.update_layout(layout)
 
     return figure
 
@@ -230,7 +430,8 @@ def read_figure(
         data_topic: str = 'G01',
         geo_area: str = 'AUST',
         gda_spec: str = 'GDA2020',
-        gda_type: str = 'SA4'
+        gda_type: str = 'SA4',
+        file_type: str = 'json'
     ):
     """
     Description
@@ -251,6 +452,8 @@ def read_figure(
         Geographic digital boundary specification (GDA94, GDA2020, ect.).
     - gda_type : str = 'SA4'
         Type of digital geo bounds to use (LGA, SA2, ect.).
+    - file_type : str = 'json'
+        File type to read the figure from (json, json.gz).
     
     Returns
     -------
@@ -263,9 +466,20 @@ def read_figure(
         f"{data_topic}_{gda_type}_{data_year}_{geo_area}_{gda_spec}"
 
     # Load figure
-    figure = pio.read_json(
-        f"{work_dir}/fig/{filename}.json",
-    )
+    if file_type == 'json.gz':
+        with gzip.open(
+                f"{work_dir}/fig/{filename}.json.gz",
+                'rb'
+            ) as f:
+            figure = pio.from_json(
+                f.read().decode(),
+                engine='orjson'
+            )
+    else:
+        figure = pio.read_json(
+            f"{work_dir}/fig/{filename}.json",
+            engine='orjson'
+        )
 
     return figure
 
@@ -291,7 +505,7 @@ def save_figure(
     - figure : plotly.graph_objects.Figure
         Plotly figure.
     - file_type : str = 'json'
-        File type to save the figure (html, json).
+        File type to save the figure (html, json, json.gz).
     - data_year : int = 2021
         Census data year (2016, 2021, ect.).
     - data_topic : str = 'G01'
@@ -323,7 +537,17 @@ def save_figure(
         pio.write_json(
             figure,
             f"{work_dir}/fig/{filename}.json",
+            engine='orjson'
         )
+    elif file_type == 'json.gz':
+        with gzip.open(
+                f"{work_dir}/fig/{filename}.json.gz",
+                'wb',
+                compresslevel=3
+            ) as f:
+            f.write(
+                pio.to_json(figure, engine='orjson').encode()
+            )
 
     return None
 
@@ -333,12 +557,16 @@ def load_local_data(
         data_topic: str = 'G01',
         geo_area: str = 'AUST',
         gda_spec: str = 'GDA2020',
-        gda_type: str = 'SA4'
+        gda_type: str = 'SA4',
+        columns: list = None,
+        bbox: tuple = (85, -50, 185, 0),
+        overwrite: bool = False
     ) -> gpd.GeoDataFrame:
     """
     Description
     -----------
-    Load geographic census data from a local file.
+    Load geographic census data from a local file, the layer is cached
+    to a parquet file on first read.
 
     Parameters
     ----------
@@ -354,6 +582,14 @@ def load_local_data(
         Geographic digital boundary specification (GDA94, GDA2020, ect.).
     - gda_type : str = 'SA4'
         Type of digital geo bounds to use (LGA, SA2, ect.).
+    - columns : list = None
+        Columns to read, geometry is always read (all columns if None).
+    - bbox : tuple = (85, -50, 185, 0)
+        Bounding box (west, south, east, north) to read features within,
+        defaults to the figure map bounds (all features if None).
+    - overwrite : bool = False
+        Overwrite cached parquet file if it exists (it is also
+        rewritten when the geopackage file changes).
 
     Returns
     -------
@@ -371,36 +607,202 @@ def load_local_data(
         f'{work_dir}/raw/{folder}/{file}'
     layer = \
         f'{data_topic}_{gda_type}_{data_year}_{geo_area}'
+    cache_filename = \
+        f'{work_dir}/raw/{folder}/{layer}.parquet'
+    mtime_filename = \
+        f'{cache_filename}.mtime'
+
+    if columns is not None:
+        columns = columns + ['geometry']
+
+    # Check cache was written from the current file
+    source_mtime = str(os.stat(filename).st_mtime_ns)
+    cache_mtime = None
+    if os.path.exists(mtime_filename):
+        with open(mtime_filename, 'r') as f:
+            cache_mtime = f.read()
+
+    # Load cached data
+    if os.path.exists(cache_filename) and \
+            cache_mtime == source_mtime and \
+            not overwrite:
+        gdf = gpd.read_parquet(
+            cache_filename,
+            columns=columns,
+            bbox=bbox
+        )
+        gdf.attrs['source_mtime'] = source_mtime
+        return gdf
 
-    # Load data
+    # Load data and cache full layer
     gdf = gpd.read_file(
         filename=filename,
-        layer=layer
+        layer=layer,
+        engine='pyogrio',
+        use_arrow=True
     )
+    gdf.to_parquet(
+        f'{cache_filename}.part',
+        compression='zstd',
+        write_covering_bbox=True
+    )
+    os.replace(f'{cache_filename}.part', cache_filename)
+    with open(mtime_filename, 'w') as f:
+        f.write(source_mtime)
+
+    # Filter columns and features
+    if columns is not None:
+        gdf = gdf[columns]
+    if bbox is not None:
+        bounds = gdf.bounds
+        mask = \
+            (bounds['minx'] <= bbox[2]) & (bounds['maxx'] >= bbox[0]) & \
+            (bounds['miny'] <= bbox[3]) & (bounds['maxy'] >= bbox[1])
+        gdf = gdf.loc[mask]
+        gdf = gdf.reset_index(drop=True)
+    gdf.attrs['source_mtime'] = source_mtime
 
     return gdf
 
-def load_cloud_data(conn_str):
+async def _download_blobs(
+        conn_str: str,
+        container_name: str,
+        work_dir: str,
+        name_starts_with: str = None,
+        overwrite: bool = False,
+        max_tasks: int = 32,
+        verbose: bool = False
+    ) -> list:
+    """
+    Description
+    -----------
+    Download blobs from a container concurrently, streaming each blob
+    to a file in the working directory.
+
+    Parameters
+    ----------
+    - conn_str : str
+        Azure blob storage connection string.
+    - container_name : str
+        Blob container name.
+    - work_dir : str
+        Working directory.
+    - name_starts_with : str = None
+        Only download blobs with names starting with this prefix.
+    - overwrite : bool = False
+        Overwrite files if they exist with the blob size.
+    - max_tasks : int = 32
+        Maximum number of blobs downloading at once.
+    - verbose : bool = False
+        Print the number of blobs found.
+
+    Returns
+    -------
+    - paths : list
+        List of downloaded file paths.
+    """
+
+    semaphore = asyncio.Semaphore(max_tasks)
 
     # Create a BlobServiceClient object using the connection string
-    blob_service_client = \
-        BlobServiceClient.from_connection_string(
+    async with BlobServiceClient.from_connection_string(
             conn_str
-        )
+        ) as blob_service_client:
 
-    # Get the container client object
-    container_name = "australian-census-data"
-    container_client = \
-        blob_service_client.get_container_client(
-            container_name
+        # Get the container client object
+        container_client = \
+            blob_service_client.get_container_client(
+                container_name
+            )
+
+        async def download_blob(name, size):
+            path = f"{work_dir}/{name}"
+            if os.path.exists(path) and \
+                    os.path.getsize(path) == size and \
+                    not overwrite:
+                return path
+
+            # Stream to a partial file, then move it into place
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            async with semaphore:
+                blob_client = container_client.get_blob_client(name)
+                downloader = await blob_client.download_blob(
+                    max_concurrency=8
+                )
+                with open(f"{path}.part", 'wb') as f:
+                    await downloader.readinto(f)
+            os.replace(f"{path}.part", path)
+
+            return path
+
+        # List the names and sizes of all blobs
+        blobs = [
+            (blob.name, blob.size)
+            async for blob in container_client.list_blobs(
+                name_starts_with=name_starts_with
+            )
+            if not blob.name.endswith('/')
+        ]
+        if verbose:
+            print(
+                f"{len(blobs)} blobs in the container '{container_name}'"
+            )
+
+        # Download all blobs
+        paths = await asyncio.gather(
+            *[download_blob(name, size) for name, size in blobs]
         )
 
-    # List all blobs in the container
-    blobs = container_client.list_blobs()
+    return list(paths)
+
+def load_cloud_data(
+        conn_str: str,
+        work_dir: str,
+        name_starts_with: str = None,
+        overwrite: bool = False,
+        verbose: bool = False
+    ) -> list:
+    """
+    Description
+    -----------
+    Download census data from cloud storage to the working directory.
+
+    Parameters
+    ----------
+    - conn_str : str
+        Azure blob storage connection string.
+    - work_dir : str
+        Working directory.
+    - name_starts_with : str = None
+        Only download blobs with names starting with this prefix.
+    - overwrite : bool = False
+        Overwrite files if they exist with the blob size.
+    - verbose : bool = False
+        Print the number of blobs found.
 
-    # Print the names of all blobs
-    print(f"Blobs in the container '{container_name}':")
-    for blob in blobs:
-        print(blob.name)
+    Returns
+    -------
+    - paths : list
+        List of downloaded file paths.
+    """
+
+    container_name = "australian-census-data"
+    download = _download_blobs(
+        conn_str,
+        container_name,
+        work_dir,
+        name_starts_with,
+        overwrite,
+        verbose=verbose
+    )
+
+    # Run on a worker thread if an event loop is running (Jupyter)
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        paths = asyncio.run(download)
+    else:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            paths = executor.submit(asyncio.run, download).result()
 
-    return blobs
\ No newline at end of file
+    return paths
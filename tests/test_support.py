@@ -0,0 +1,243 @@
+import os
+
+import pytest
+
+gpd = pytest.importorskip('geopandas')
+shapely = pytest.importorskip('shapely')
+pytest.importorskip('plotly')
+pytest.importorskip('azure.storage.blob')
+
+import package.support as support
+
+
+def test_cull_viewport_keeps_visible_shape():
+    triangle = shapely.Polygon([(0, 0), (10, 10), (0, 10)])
+    outside = shapely.box(20, 20, 30, 30)
+    figure_df = gpd.GeoDataFrame(
+        {'Population': [1, 2]},
+        geometry=[triangle, outside],
+        index=['Inside', 'Outside']
+    )
+    viewport = dict(west=-1, east=5, south=-1, north=11)
+
+    culled = support._cull_viewport(figure_df, viewport)
+
+    assert list(culled.index) == ['Inside']
+    geometry = culled.geometry.iloc[0]
+    expected = triangle.intersection(shapely.box(-1, -1, 5, 11))
+    assert geometry.is_valid
+    assert geometry.normalize().equals(expected.normalize())
+    assert geometry.contains(shapely.Point(4, 5))
+    assert geometry.bounds[2] <= viewport['east']
+
+
+@pytest.mark.parametrize('file_type', ['json', 'json.gz'])
+def test_save_and_read_figure_round_trip(tmp_path, file_type):
+    pytest.importorskip('orjson')
+    import plotly.graph_objects as go
+
+    (tmp_path / 'fig').mkdir()
+    figure = go.Figure(
+        data=[go.Scatter(x=[1, 2], y=[3, 4])],
+        layout=dict(height=650)
+    )
+
+    support.save_figure(str(tmp_path), figure, file_type)
+    read = support.read_figure(str(tmp_path), file_type=file_type)
+
+    assert list(read.data[0].y) == [3, 4]
+    assert read.layout.height == 650
+
+
+def test_read_figure_ignores_other_file_type(tmp_path):
+    pytest.importorskip('orjson')
+    import plotly.graph_objects as go
+
+    (tmp_path / 'fig').mkdir()
+    old = go.Figure(layout=dict(height=100))
+    new = go.Figure(layout=dict(height=200))
+    support.save_figure(str(tmp_path), old, 'json.gz')
+    support.save_figure(str(tmp_path), new, 'json')
+
+    read = support.read_figure(str(tmp_path))
+
+    assert read.layout.height == 200
+
+
+DATA_CONFIG = {
+    'data_year': 2021,
+    'data_topic': 'G01',
+    'geo_area': 'AUST',
+    'gda_spec': 'GDA2020',
+    'gda_type': 'SA4'
+}
+
+
+@pytest.fixture
+def figure_df():
+    support._GEOJSON_CACHE.clear()
+    figure_df = gpd.GeoDataFrame(
+        {'Population': [1, 2, 3]},
+        geometry=[
+            shapely.box(130, -30, 131, -29),
+            shapely.box(131, -30, 132, -29),
+            shapely.box(132, -30, 133, -29)
+        ],
+        index=['A', 'B', 'C'],
+        crs='EPSG:4326'
+    )
+    figure_df.attrs['source_mtime'] = '1'
+    yield figure_df
+    support._GEOJSON_CACHE.clear()
+
+
+def test_geojson_for_reuses_same_boundary(figure_df):
+    first = support._geojson_for(figure_df, DATA_CONFIG)
+    second = support._geojson_for(figure_df.copy(), DATA_CONFIG)
+
+    assert second is first
+    assert [x['id'] for x in first['features']] == ['A', 'B', 'C']
+
+
+def test_geojson_for_recomputes_for_other_locations(figure_df):
+    subset = support._geojson_for(figure_df.iloc[:1], DATA_CONFIG)
+    full = support._geojson_for(figure_df, DATA_CONFIG)
+
+    assert [x['id'] for x in subset['features']] == ['A']
+    assert [x['id'] for x in full['features']] == ['A', 'B', 'C']
+
+
+def test_geojson_for_recomputes_for_other_crs_or_source(figure_df):
+    first = support._geojson_for(figure_df, DATA_CONFIG)
+
+    projected = figure_df.to_crs('EPSG:3857')
+    assert support._geojson_for(projected, DATA_CONFIG) is not first
+
+    replaced = figure_df.copy()
+    replaced.attrs['source_mtime'] = '2'
+    assert support._geojson_for(replaced, DATA_CONFIG) is not first
+
+
+def test_geojson_for_does_not_cache_unknown_source(figure_df):
+    figure_df.attrs.clear()
+
+    support._geojson_for(figure_df, DATA_CONFIG)
+
+    assert len(support._GEOJSON_CACHE) == 0
+
+
+def test_geojson_cache_is_bounded(figure_df):
+    for tolerance in [0.1, 0.2, 0.3]:
+        support._geojson_for(figure_df, DATA_CONFIG, tolerance)
+
+    assert len(support._GEOJSON_CACHE) == support._GEOJSON_CACHE_SIZE
+
+
+@pytest.fixture
+def raw_gdf():
+    return gpd.GeoDataFrame(
+        {
+            'SA4_NAME_2021': ['A', 'B', 'C'],
+            'Tot_P_P': [1.0, 2.0, 3.0],
+            'Tot_M_P': [0.0, 1.0, 1.0]
+        },
+        geometry=[
+            shapely.box(130, -30, 131, -29),
+            None,
+            shapely.box(132, -30, 133, -29)
+        ],
+        index=[10, 11, 12],
+        crs='EPSG:4326'
+    )
+
+
+def test_process_data_output(raw_gdf):
+    gdf_column = {'name': 'Tot_P_P', 'rename': 'Population', 'type': 'int'}
+
+    gdf = support.process_data(raw_gdf, gdf_column, 2021, 'SA4')
+
+    assert list(gdf.columns) == ['Location', 'Population', 'geometry']
+    assert list(gdf.index) == [0, 1]
+    assert list(gdf['Location']) == ['A', 'C']
+    assert list(gdf['Population']) == [1, 3]
+    assert gdf['Population'].dtype == 'int64'
+    assert gdf.crs == raw_gdf.crs
+    assert gdf.geometry.iloc[1].equals(raw_gdf.geometry.iloc[2])
+
+
+@pytest.mark.parametrize('column_type', ['Int64', 'category', 'string'])
+def test_process_data_pandas_types(raw_gdf, column_type):
+    gdf_column = {
+        'name': 'Tot_P_P',
+        'rename': 'Population',
+        'type': column_type
+    }
+
+    gdf = support.process_data(raw_gdf, gdf_column, 2021, 'SA4')
+
+    assert gdf['Population'].dtype == column_type
+    assert len(gdf) == 2
+
+
+def write_geopackage(work_dir, population):
+    folder = work_dir / 'raw' / 'Geopackage_2021_G01_AUST_GDA2020'
+    folder.mkdir(parents=True, exist_ok=True)
+    filename = folder / 'G01_AUST_GDA2020.gpkg'
+    gdf = gpd.GeoDataFrame(
+        {
+            'SA4_NAME_2021': ['A', 'B'],
+            'Tot_P_P': population
+        },
+        geometry=[
+            shapely.box(130, -30, 131, -29),
+            shapely.box(0, 10, 1, 11)
+        ],
+        crs='EPSG:7844'
+    )
+    gdf.to_file(
+        filename,
+        layer='G01_SA4_2021_AUST',
+        driver='GPKG',
+        engine='pyogrio'
+    )
+    return filename
+
+
+def test_load_local_data_cold_and_warm_reads_match(tmp_path):
+    pytest.importorskip('pyogrio')
+    pytest.importorskip('pyarrow')
+    write_geopackage(tmp_path, [1, 2])
+
+    cold = support.load_local_data(str(tmp_path))
+    warm = support.load_local_data(str(tmp_path))
+
+    assert list(cold['SA4_NAME_2021']) == ['A']
+    assert list(warm['SA4_NAME_2021']) == ['A']
+
+
+def test_load_local_data_rereads_changed_geopackage(tmp_path):
+    pytest.importorskip('pyogrio')
+    pytest.importorskip('pyarrow')
+    filename = write_geopackage(tmp_path, [1, 2])
+    support.load_local_data(str(tmp_path), bbox=None)
+
+    mtime = os.stat(filename).st_mtime_ns
+    write_geopackage(tmp_path, [5, 6])
+    os.utime(filename, ns=(mtime + 10**9, mtime + 10**9))
+    gdf = support.load_local_data(str(tmp_path), bbox=None)
+
+    assert list(gdf['Tot_P_P']) == [5, 6]
+
+
+def test_geojson_for_null_geometry(figure_df):
+    figure_df = figure_df.set_geometry(
+        [shapely.box(130, -30, 131, -29), None, None],
+        crs='EPSG:4326'
+    )
+
+    geojson = support._geojson_for(figure_df)
+
+    assert [x['id'] for x in geojson['features']] == ['A', 'B', 'C']
+    assert geojson['features'][0]['geometry']['type'] == 'Polygon'
+    assert geojson['features'][1]['geometry'] is None
+    assert geojson['features'][2]['geometry'] is None